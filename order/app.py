@@ -1,24 +1,39 @@
+from gevent import monkey
+
+monkey.patch_all()
+
 import os
 import atexit
+import logging
 import uuid
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, jsonify
 import redis
-import json
-from kafka import KafkaProducer
-from kafka import KafkaConsumer
-from kafka import TopicPartition
-from queue import Queue
-from threading import Thread
+from cachetools import TTLCache
+import orjson
+from confluent_kafka import (
+    OFFSET_END,
+    Consumer,
+    KafkaException,
+    Producer,
+    TopicPartition,
+)
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from threading import Lock, Thread
 import time
 
 app = Flask("order-service")
 
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+
 db: redis.Redis = redis.Redis(
     host=os.environ["REDIS_HOST"],
     port=int(os.environ["REDIS_PORT"]),
     password=os.environ["REDIS_PASSWORD"],
     db=int(os.environ["REDIS_DB"]),
+    decode_responses=True,
 )
 
 running_in_kubernetes = os.environ.get("RUNNING_IN_KUBERNETES")
@@ -29,6 +44,17 @@ if running_in_kubernetes:
 else:
     gateway_url = os.environ["GATEWAY_URL"]
 
+# One keep-alive connection pool for every call to the stock and payment
+# services, so requests skip the TCP handshake.
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=128, pool_maxsize=128, max_retries=Retry(total=0)
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+# (connect, read) timeouts in seconds
+REQUEST_TIMEOUT = (1.0, 5.0)
+
 
 def close_db_connection():
     db.close()
@@ -36,222 +62,331 @@ def close_db_connection():
 
 atexit.register(close_db_connection)
 
+# Appends an item to the order and bumps its total cost in one atomic step.
+# Returns -1 if the order does not exist, otherwise the new total cost.
+ADD_ITEM_SCRIPT = db.register_script(
+    """
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return -1
+    end
+    redis.call('RPUSH', KEYS[2], ARGV[1])
+    return redis.call('HINCRBY', KEYS[1], 'total_cost', ARGV[2])
+    """
+)
+
+# Removes one occurrence of an item and lowers the total cost accordingly.
+# Returns -1 if the order does not exist, 0 if the item is not in the order
+# and 1 on success.
+REMOVE_ITEM_SCRIPT = db.register_script(
+    """
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return -1
+    end
+    if redis.call('LREM', KEYS[2], 1, ARGV[1]) == 0 then
+        return 0
+    end
+    redis.call('HINCRBY', KEYS[1], 'total_cost', -tonumber(ARGV[2]))
+    return 1
+    """
+)
+
+
+# Item prices rarely change, so keep them per process for a short while
+# instead of asking the stock service on every addItem/removeItem.
+item_price_cache = TTLCache(maxsize=10000, ttl=30)
+item_price_cache_lock = Lock()
+
 
 def get_item_price(item_id):
+    with item_price_cache_lock:
+        price = item_price_cache.get(item_id)
+    if price is not None:
+        return price
+
     if running_in_kubernetes:
-        response = requests.get(f"{stock_service_url}/find/{item_id}")
+        response = SESSION.get(
+            f"{stock_service_url}/find/{item_id}", timeout=REQUEST_TIMEOUT
+        )
     else:
-        response = requests.get(f"{gateway_url}/stock/find/{item_id}")
+        response = SESSION.get(
+            f"{gateway_url}/stock/find/{item_id}", timeout=REQUEST_TIMEOUT
+        )
 
     if response.status_code == 200:
-        return response.json()["price"]
+        price = response.json()["price"]
+        with item_price_cache_lock:
+            item_price_cache[item_id] = price
+        return price
     else:
         return None
 
 
 def subtract_stock_quantity(item_id, quantity):
     if running_in_kubernetes:
-        response = requests.post(f"{stock_service_url}/subtract/{item_id}/{quantity}")
+        response = SESSION.post(
+            f"{stock_service_url}/subtract/{item_id}/{quantity}",
+            timeout=REQUEST_TIMEOUT,
+        )
     else:
-        response = requests.post(f"{gateway_url}/stock/subtract/{item_id}/{quantity}")
+        response = SESSION.post(
+            f"{gateway_url}/stock/subtract/{item_id}/{quantity}",
+            timeout=REQUEST_TIMEOUT,
+        )
 
     return response.status_code == 200
 
 
 def add_stock_quantity(item_id, quantity):
     if running_in_kubernetes:
-        response = requests.post(f"{stock_service_url}/add/{item_id}/{quantity}")
+        response = SESSION.post(
+            f"{stock_service_url}/add/{item_id}/{quantity}", timeout=REQUEST_TIMEOUT
+        )
     else:
-        response = requests.post(f"{gateway_url}/stock/add/{item_id}/{quantity}")
+        response = SESSION.post(
+            f"{gateway_url}/stock/add/{item_id}/{quantity}", timeout=REQUEST_TIMEOUT
+        )
 
     return response.status_code == 200
 
 
 def process_payment(user_id, order_id, total_cost):
     if running_in_kubernetes:
-        response = requests.post(
-            f"{user_service_url}/pay/{user_id}/{order_id}/{total_cost}"
+        response = SESSION.post(
+            f"{user_service_url}/pay/{user_id}/{order_id}/{total_cost}",
+            timeout=REQUEST_TIMEOUT,
         )
     else:
-        response = requests.post(
-            f"{gateway_url}/payment/pay/{user_id}/{order_id}/{total_cost}"
+        response = SESSION.post(
+            f"{gateway_url}/payment/pay/{user_id}/{order_id}/{total_cost}",
+            timeout=REQUEST_TIMEOUT,
         )
     return response
 
 
 def cancel_payment(user_id, order_id):
     if running_in_kubernetes:
-        response = requests.post(f"{user_service_url}/cancel/{user_id}/{order_id}")
+        response = SESSION.post(
+            f"{user_service_url}/cancel/{user_id}/{order_id}", timeout=REQUEST_TIMEOUT
+        )
     else:
-        response = requests.post(f"{gateway_url}/payment/cancel/{user_id}/{order_id}")
+        response = SESSION.post(
+            f"{gateway_url}/payment/cancel/{user_id}/{order_id}",
+            timeout=REQUEST_TIMEOUT,
+        )
     return response.status_code == 200
 
 
 @app.post("/create/<user_id>")
 def create_order(user_id):
     order_id = str(uuid.uuid4())
-    # Making a transaction with pipeline
-    pipe = db.pipeline(transaction=True)
     key = "order:" + order_id
-    items = []
     try:
-        pipe.multi()
-        pipe.hset(key, "order_id", order_id)
-        pipe.hset(key, "paid", "False")
-        pipe.hset(key, "items", json.dumps(items))
-        pipe.hset(key, "user_id", user_id)
-        pipe.hset(key, "total_cost", 0)
-        pipe.execute()
+        # A single HSET with all fields is atomic on its own, no MULTI/EXEC needed.
+        # The items live in a separate list under order:<order_id>:items.
+        db.hset(
+            key,
+            mapping={
+                "order_id": order_id,
+                "paid": "False",
+                "user_id": user_id,
+                "total_cost": 0,
+            },
+        )
         return jsonify({"order_id": order_id}), 200
     except Exception as e:
-        # If an error occurs the transaction will be aborted and no commands will be executed.
         return str(e), 500
-    finally:
-        # Resetting the pipeline will restore it to its initial state.
-        pipe.reset()
 
 
 @app.delete("/remove/<order_id>")
 def remove_order(order_id):
-    pipe = db.pipeline(transaction=True)
     try:
-        pipe.delete(f"order:{order_id}")
-        result = pipe.execute()
-        if result[0] == 0:
+        # the items list only exists alongside its order hash
+        if db.delete(f"order:{order_id}", f"order:{order_id}:items") == 0:
             return jsonify({"error": "Order not found"}), 400
         return jsonify({"status": "success"}), 200
     except Exception as e:
         return str(e), 500
-    finally:
-        pipe.reset()
 
 
 @app.post("/addItem/<order_id>/<item_id>")
 def add_item(order_id, item_id):
     order_key = f"order:{order_id}"
+    items_key = f"order:{order_id}:items"
 
-    pipe = db.pipeline(transaction=True)
     try:
-        pipe.watch(order_key)
-        pipe.multi()
-        pipe.exists(order_key)
-        pipe.hgetall(order_key)
-        result = pipe.execute()
-        print("add_item, result === ", result)
-        # app.logger.debug(f"Pipeline result: {result}")
-        if not result:
-            return jsonify({"error": "Result Error In Pipe Execution"}), 400
-        if not result[0]:
-            return jsonify({"error": "The order_key does not exist"}), 400
-        order_data = result[1]
         item_price = get_item_price(item_id)
         if item_price is None:
             return jsonify({"error": "Item not found"}), 400
-        items = json.loads(order_data[b"items"].decode())
-        items.append(item_id)
-        total_cost = int(order_data[b"total_cost"]) + item_price
-        pipe.multi()
-        pipe.hset(order_key, "items", json.dumps(items))
-        pipe.hset(order_key, "total_cost", total_cost)
-        pipe.execute()
+        result = ADD_ITEM_SCRIPT(
+            keys=[order_key, items_key], args=[item_id, item_price]
+        )
+        if result == -1:
+            return jsonify({"error": "The order_key does not exist"}), 400
         return jsonify({"status": "success"}), 200
     except Exception as e:
         return str({"error": str(e), "type": str(type(e))}), 500
-    finally:
-        pipe.unwatch()
 
 
 @app.delete("/removeItem/<order_id>/<item_id>")
 def remove_item(order_id, item_id):
     order_key = f"order:{order_id}"
-    print("remove_item, order_key === ", order_key)
-    pipe = db.pipeline(transaction=True)
+    items_key = f"order:{order_id}:items"
     try:
-        pipe.watch(order_key)
-        pipe.multi()
-        pipe.hgetall(order_key)
-        result = pipe.execute()
-        print("remove_item, result === ", result)
-        order_data = result[0]
-        print("remove_item, order_data === ", order_data)
-        if not order_data:
-            return jsonify({"error": "Order not found"}), 400
         item_price = get_item_price(item_id)
         if item_price is None:
             return jsonify({"error": "Item not found"}), 400
-        items = json.loads(order_data[b"items"].decode())
-        if item_id not in items:
+        result = REMOVE_ITEM_SCRIPT(
+            keys=[order_key, items_key], args=[item_id, item_price]
+        )
+        if app.logger.isEnabledFor(logging.DEBUG):
+            app.logger.debug("remove_item %s, result === %s", order_key, result)
+        if result == -1:
+            return jsonify({"error": "Order not found"}), 400
+        if result == 0:
             return jsonify({"error": "Item not in order"}), 400
-        items.remove(item_id)
-        total_cost = int(order_data[b"total_cost"]) - item_price
-        pipe.multi()
-        pipe.hset(order_key, "items", json.dumps(items))
-        pipe.hset(order_key, "total_cost", total_cost)
-        pipe.execute()
         return jsonify({"status": "success"}), 200
     except Exception as e:
         return str(e), 500
-    finally:
-        pipe.unwatch()
 
 
 @app.get("/find/<order_id>")
 def find_order(order_id):
     order_key = f"order:{order_id}"
+    items_key = f"order:{order_id}:items"
     pipe = db.pipeline(transaction=True)
     try:
-        pipe.watch(order_key)
-        pipe.multi()
         pipe.hgetall(order_key)
+        pipe.lrange(items_key, 0, -1)
         result = pipe.execute()
         order_data = result[0]
         if not order_data:
             return jsonify({"error": "Order not found"}), 400
-        order = {
-            key.decode(): (
-                value.decode() if key != b"items" else json.loads(value.decode())
-            )
-            for key, value in order_data.items()
-        }
-        return jsonify(order), 200
+        return jsonify({**order_data, "items": result[1]}), 200
     except Exception as e:
         return str(e), 500
     finally:
-        pipe.unwatch()
+        pipe.reset()
 
 
-producer = KafkaProducer(
-    bootstrap_servers="kafka-service:9092",
-    api_version=(0, 11, 5),
-    value_serializer=lambda v: json.dumps(v).encode("utf-8"),
-    key_serializer=lambda v: json.dumps(v).encode("utf-8"),
+producer = Producer(
+    {
+        "bootstrap.servers": "kafka-service:9092",
+        # let concurrent checkouts share batches instead of one request per send
+        "linger.ms": 5,
+        "batch.size": 131072,
+        "compression.type": "lz4",
+        # a lost checkout message would leave the saga hanging, so keep leader acks
+        "acks": "1",
+        "max.in.flight.requests.per.connection": 5,
+        "queue.buffering.max.messages": 1000000,
+    }
 )
-consumer = KafkaConsumer(
-    bootstrap_servers="kafka-service:9092",
-    api_version=(0, 11, 5),
-    auto_offset_reset="earliest",
-    value_deserializer=lambda x: json.loads(x.decode("utf-8")),
-    key_deserializer=lambda x: json.loads(x.decode("utf-8")),
+consumer = Consumer(
+    {
+        "bootstrap.servers": "kafka-service:9092",
+        # offsets are never committed, the group id only satisfies librdkafka
+        "group.id": f"order-service-{uuid.uuid4()}",
+        "enable.auto.commit": False,
+        # results from before this worker started can never match a checkout
+        "auto.offset.reset": "latest",
+    }
 )
 
-consumer.assign([TopicPartition("order_result_topic", 0)])
-print("waiting for order result, consumer has subscribed to order_result_topic")
 
+def send_message(topic, key, value, partition=0):
+    producer.produce(
+        topic, key=orjson.dumps(key), value=orjson.dumps(value), partition=partition
+    )
+    # serve delivery callbacks so the local queue does not fill up
+    producer.poll(0)
+
+
+def close_producer():
+    # stay well inside gunicorn's 30 s graceful timeout if the broker is down
+    remaining = producer.flush(timeout=5)
+    if remaining:
+        app.logger.warning("%d Kafka messages undelivered at shutdown", remaining)
 
-# this function will be executed in a separate thread for each API call
-def kafka_consumer_thread(consumer, queue, global_transaction_id):
-    for message in consumer:
-        print("Received message:", message)
-        if message.key == global_transaction_id:
-            queue.put(message.value)
-            break
+
+atexit.register(close_producer)
+
+result_topic = consumer.list_topics("order_result_topic").topics["order_result_topic"]
+result_partitions = list(result_topic.partitions) or [0]
+
+
+def result_partition_end(partition):
+    # Pin the current end offset so the start position is fixed before the
+    # first checkout is sent, rather than resolved on the first fetch.
+    try:
+        return consumer.get_watermark_offsets(
+            TopicPartition("order_result_topic", partition), timeout=10
+        )[1]
+    except KafkaException:
+        return OFFSET_END
+
+
+consumer.assign(
+    [
+        TopicPartition("order_result_topic", partition, result_partition_end(partition))
+        for partition in result_partitions
+    ]
+)
+app.logger.info(
+    "waiting for order result, consumer has subscribed to order_result_topic"
+)
+
+# checkouts waiting for their result, keyed by the serialized
+# global_transaction_id as it appears on the wire, so results for other
+# checkouts are skipped without being parsed
+pending_checkouts: dict[bytes, Future] = {}
+pending_checkouts_lock = Lock()
+
+
+def dispatch_result(message):
+    if message.error():
+        app.logger.error("Consumer error: %s", message.error())
+        return
+    key = message.key()
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug("Received message: %s %s", key, message.value())
+    with pending_checkouts_lock:
+        future = pending_checkouts.pop(key, None)
+    if future is None:
+        return
+    # this thread serves every checkout, so a bad record must only fail its own
+    try:
+        future.set_result(orjson.loads(message.value()))
+    except Exception as e:
+        app.logger.exception("Failed to dispatch order result for %s", key)
+        future.set_exception(e)
+
+
+# single background thread that hands every order result to the waiting checkout
+def kafka_consumer_thread():
+    while True:
+        # librdkafka blocks outside of gevent, so never wait inside consume().
+        # Read bounded batches and yield after each one so a burst of results
+        # cannot starve request greenlets or the gunicorn heartbeat.
+        messages = consumer.consume(num_messages=100, timeout=0)
+        for message in messages:
+            dispatch_result(message)
+        # When idle, sleep 5 ms between polls: this adds up to 5 ms to a
+        # checkout's result and wakes the loop ~200 times a second, in exchange
+        # for never blocking the hub.
+        time.sleep(0 if messages else 0.005)
+
+
+Thread(target=kafka_consumer_thread, daemon=True).start()
+
+
+CHECKOUT_ORDER_FIELDS = ("order_id", "user_id", "total_cost")
 
 
 @app.post("/checkout/<order_id>")
 def checkout(order_id):
     global_transaction_id = str(uuid.uuid4())
     order_key = f"order:{order_id}"
-    global_transaction_key = f"global_transaction_id:{global_transaction_id}"
+    items_key = f"order:{order_id}:items"
     pipe = db.pipeline(transaction=True)
 
     try:
@@ -269,23 +404,21 @@ def checkout(order_id):
         # pipe.hset(global_transaction_key, "order_id", order_id)
         # pipe.execute()
 
-        pipe.watch(order_key)
-        pipe.multi()
-        pipe.hgetall(order_key)
+        # only the fields the payment consumer reads are sent along
+        pipe.hmget(order_key, CHECKOUT_ORDER_FIELDS)
+        pipe.lrange(items_key, 0, -1)
         result = pipe.execute()
-        # order_data = result[0]
-        order_data = byte_keys_to_str(result[0])
-        if not order_data:
+        if result[0][0] is None:
             return jsonify({"error": "Order not found"}), 400
+        order_data = dict(zip(CHECKOUT_ORDER_FIELDS, result[0]))
         # if we have order_data:
         # user_id = order_data[b"user_id"].decode()
         # total_cost = int(order_data[b"total_cost"])
 
         # Start of stock check
-        # items = json.loads(order_data[b"items"].decode())
-        items = order_data["items"]
-        list_data = json.loads(items)
-        order_data["items"] = list_data
+        # Serialize the items once and embed the same JSON in both messages.
+        items_json = orjson.Fragment(orjson.dumps(result[1]))
+        order_data["items"] = items_json
         # producer.send(
         #     "checkout_topic",
         #     value={"order_data": order_data, "status": "pending"},
@@ -293,67 +426,59 @@ def checkout(order_id):
         # )
         # Start of stock check and payment processing.
         # Send a message to Kafka instead of calling the microservices directly.
-        # print("sending stock check message of order_id: ", order_id)
-        producer.send(
-            "stock_check_topic",
-            value={
-                "affected_items": list_data,
-                "action": "remove",
-                "is_roll_back": "false",
-                "callFrom": "checkout",
-            },
-            key=global_transaction_id,
-            partition=0,
-        )
-        # print("sending payment processing message of order_id: ", order_id)
-        producer.send(
-            "payment_processing_topic",
-            value={
-                "order_data": order_data,
-                "action": "pay",
-                "is_roll_back": "false",
-                "callFrom": "checkout",
-            },
-            key=global_transaction_id,
-            partition=0,
-        )
-
-        # for message in consumer:
-        #     print("unpack message result in line 312", message)
-        #     if message.key == global_transaction_id:
-        #         msg = message.value
-        #         if msg["status"] == "success":
-        #             return jsonify({"status": "success"}), 200
-        #         else:
-        #             return jsonify({"error": "Payment failed"}), 400
-        # return jsonify({"error": "Wait too long, quit"}), 400
-
-        queue = Queue()
-        consumer_thread = Thread(
-            target=kafka_consumer_thread, args=(consumer, queue, global_transaction_id)
-        )
-        consumer_thread.start()
+        result_key = orjson.dumps(global_transaction_id)
+        future = Future()
+        with pending_checkouts_lock:
+            pending_checkouts[result_key] = future
+        try:
+            # print("sending stock check message of order_id: ", order_id)
+            send_message(
+                "stock_check_topic",
+                key=global_transaction_id,
+                value={
+                    "affected_items": items_json,
+                    "action": "remove",
+                    "is_roll_back": "false",
+                    "callFrom": "checkout",
+                },
+            )
+            # print("sending payment processing message of order_id: ", order_id)
+            send_message(
+                "payment_processing_topic",
+                key=global_transaction_id,
+                value={
+                    "order_data": order_data,
+                    "action": "pay",
+                    "is_roll_back": "false",
+                    "callFrom": "checkout",
+                },
+            )
 
-        # wait for the consumer thread to put a message in the queue
-        while True:
+            # for message in consumer:
+            #     print("unpack message result in line 312", message)
+            #     if message.key == global_transaction_id:
+            #         msg = message.value
+            #         if msg["status"] == "success":
+            #             return jsonify({"status": "success"}), 200
+            #         else:
+            #             return jsonify({"error": "Payment failed"}), 400
+            # return jsonify({"error": "Wait too long, quit"}), 400
+
+            # wait for the consumer thread to resolve the future
             try:
-                msg = queue.get(timeout=10)  # wait for 10 seconds
-                if msg["status"] == "success":
-                    return jsonify({"status": "success"}), 200
-                else:
-                    return jsonify({"status": "failure"}), 400
-            except queue.Empty:
-                print("No message received after 10 seconds, retrying...")
-                continue
+                msg = future.result(timeout=10)
+            except FutureTimeoutError:
+                return jsonify({"error": "Wait too long, quit"}), 400
+        finally:
+            # also drop the entry when sending fails, not only after waiting
+            with pending_checkouts_lock:
+                pending_checkouts.pop(result_key, None)
+        if msg["status"] == "success":
+            return jsonify({"status": "success"}), 200
+        else:
+            return jsonify({"status": "failure"}), 400
 
     except Exception as e:
         return str(e), 500
     finally:
-        pipe.unwatch()
-
-
-def byte_keys_to_str(dictionary):
-    return {
-        k.decode("utf-8"): v.decode("utf-8") if isinstance(v, bytes) else v
-        for k, v in dictionary.items()
-    }
+        pipe.reset()
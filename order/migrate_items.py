@@ -0,0 +1,56 @@
+"""
+One-off migration for orders created before items moved to a Redis list.
+
+Older orders keep their items as a JSON string in the "items" field of the
+order:<order_id> hash. This moves them into the order:<order_id>:items list
+and removes the field. Each order is migrated atomically and the script is
+safe to run more than once.
+
+Run it inside an order container, against the order Redis:
+    python migrate_items.py
+"""
+import os
+
+import redis
+
+# Prepends the legacy items (keeping their order) in front of anything added
+# to the list since, then drops the field. Returns the number of items moved,
+# or -1 if the order has no legacy field.
+MIGRATE_ORDER_SCRIPT = """
+local items = redis.call('HGET', KEYS[1], 'items')
+if not items then
+    return -1
+end
+local decoded = cjson.decode(items)
+for i = #decoded, 1, -1 do
+    redis.call('LPUSH', KEYS[2], decoded[i])
+end
+redis.call('HDEL', KEYS[1], 'items')
+return #decoded
+"""
+
+
+def main():
+    db = redis.Redis(
+        host=os.environ["REDIS_HOST"],
+        port=int(os.environ["REDIS_PORT"]),
+        password=os.environ["REDIS_PASSWORD"],
+        db=int(os.environ["REDIS_DB"]),
+        decode_responses=True,
+    )
+    migrate_order = db.register_script(MIGRATE_ORDER_SCRIPT)
+
+    orders = 0
+    items = 0
+    # the items lists share the order: prefix, only the hashes can hold the field
+    for order_key in db.scan_iter(match="order:*", count=1000, _type="hash"):
+        moved = migrate_order(keys=[order_key, f"{order_key}:items"])
+        if moved >= 0:
+            orders += 1
+            items += moved
+    print(f"migrated {items} items from {orders} orders")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()